@@ -1,209 +1,319 @@
+import ast
+import copy
 import json
+import operator
 import os
 import random
 import zipfile
 import re
-import shutil
-import hashlib
-import io
-import urllib
+import urllib.parse
+from functools import lru_cache
 from lxml import etree as ET
 from lxml.etree import QName
 
+# Use orjson's faster parser when it is installed
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# Number of randomized versions generated for each question
+NUM_VERSIONS = 1
+
+# Source of all variable draws; seed it for a reproducible package
+rng = random.Random()
+
 def load_json(file_name):
     """Load the JSON file and return its contents."""
-    with open(file_name, "r", encoding="utf-8") as file:
-        return json.load(file)
+    with open(file_name, "rb") as file:
+        return _json_loads(file.read())
 
 def generate_equation_url(equation):
-    # Encode the LaTeX equation twice as required by Canvas
+    # Encode the LaTeX equation twice as required by Canvas. The first pass
+    # leaves only safe characters and %XX escapes, so the second pass reduces
+    # to escaping each '%'
     first_encoded = urllib.parse.quote(equation)
-    double_encoded = urllib.parse.quote(first_encoded)
+    double_encoded = first_encoded.replace('%', '%25')
     
     base_url = "https://canvas.lms.unimelb.edu.au/equation_images/"
     return f"{base_url}{double_encoded}?scale=1"
 
 
+# Tokens that open or close a brace group; eval{ opens an expression to evaluate
+_EVAL_TOKEN_RE = re.compile(r'eval{|[{}]')
+
+# Largest integer power (in bits) eval{...} may compute, so 9**9**9 fails fast
+_MAX_POWER_BITS = 10_000
+
+def bounded_pow(base, exponent):
+    """Raise base to exponent, refusing integer results too large to compute quickly."""
+    if (isinstance(base, int) and isinstance(exponent, int) and abs(base) > 1
+            and exponent * base.bit_length() > _MAX_POWER_BITS):
+        raise ValueError(f"exponent too large: {exponent}")
+    return operator.pow(base, exponent)
+
+# Arithmetic allowed inside eval{...}; anything else is rejected
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: bounded_pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+@lru_cache(maxsize=4096)
+def parse_expression(expr):
+    """Parse an embedded expression once, however many versions use it."""
+    # Strip surrounding whitespace as eval() does, so padded blocks like eval{ 2*3 } still parse
+    return ast.parse(expr.strip(), '<eval>', mode='eval').body
+
+def evaluate_arithmetic(node):
+    """Evaluate a parsed expression made only of numbers and arithmetic operators."""
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        return _BINARY_OPERATORS[type(node.op)](evaluate_arithmetic(node.left), evaluate_arithmetic(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](evaluate_arithmetic(node.operand))
+    raise ValueError(f"unsupported expression {ast.unparse(node)!r}")
+
 def evaluate_embedded_expressions(s: str) -> str:
-    def eval_match(match):
-        expr = match.group(1)
+    def evaluate(expr):
         try:
-            result = eval(expr)
+            result = evaluate_arithmetic(parse_expression(expr))
         except Exception as e:
             result = f"[eval error: {e}]"
         return str(result)
 
-    # Evaluate all nested eval{...} expressions
-    while re.search(r'eval{([^{}]*)}', s):
-        s = re.sub(r'eval{([^{}]*)}', eval_match, s)
-
-    return s
-
-def process_question(question, version_id):
-    """Randomize variables and update question prompt and choices."""
-    # Create a dictionary to store the randomized values
-    randomized_values = {}
-
-    # Loop through each variable in the 'variables' field and randomize it
-    for var_name, var_values in question['variables'].items():
-        randomized_values[var_name] = random.choice(var_values)
-    
-    # Update the prompt with the randomized variables (using ~ as placeholders)
-    updated_prompt = question['prompt']
-    for var_name, value in randomized_values.items():
-        updated_prompt = updated_prompt.replace(f'~{var_name}', str(value))
-        updated_prompt = evaluate_embedded_expressions(updated_prompt)
-
-    # Update the choices based on the randomized variables
-    updated_choices = []
-    for choice in question['choices']:
-        updated_choice = choice
-        for var_name, value in randomized_values.items():
-            updated_choice = updated_choice.replace(f'~{var_name}', str(value))
-
-        updated_choice = evaluate_embedded_expressions(updated_choice)
-        updated_choices.append(updated_choice)
-
-    # Update the correct answer based on the randomized variables
-    updated_correct_answer = question['correct']
-    for var_name, value in randomized_values.items():
-        updated_correct_answer = updated_correct_answer.replace(f'~{var_name}', str(value))
-    updated_correct_answer = evaluate_embedded_expressions(updated_correct_answer)
-
-    # Return the processed question with updated prompt, choices, and correct answer
+    # Walk the braces once with a stack, evaluating each eval{...} as it closes
+    # so nested blocks are resolved innermost first
+    out = []
+    stack = []  # (is_eval, index in out where the group starts)
+    last = 0
+    for match in _EVAL_TOKEN_RE.finditer(s):
+        out.append(s[last:match.start()])
+        last = match.end()
+        token = match.group()
+        if token != '}':
+            stack.append((token == 'eval{', len(out)))
+        elif stack:
+            is_eval, start = stack.pop()
+            if is_eval:
+                expr = ''.join(out[start + 1:])
+                del out[start:]
+                out.append(evaluate(expr))
+                continue
+        out.append(token)
+    out.append(s[last:])
+
+    return ''.join(out)
+
+@lru_cache(maxsize=4096)
+def variable_pattern(var_names):
+    """Compile a regex matching any ~var placeholder, longest names first."""
+    names = sorted(var_names, key=len, reverse=True)
+    return re.compile('~(' + '|'.join(re.escape(name) for name in names) + ')')
+
+@lru_cache(maxsize=4096)
+def split_template(pattern, text):
+    """Split text on ~var placeholders once; literals sit at even indices, names at odd."""
+    return tuple(pattern.split(text))
+
+def process_question(question, version_id, randomized_values=None, correct_index=None):
+    """Randomize variables (unless pre-drawn) and update question prompt and choices."""
+    if randomized_values is None:
+        # Loop through each variable in the 'variables' field and randomize it
+        randomized_values = {}
+        for var_name, var_values in question['variables'].items():
+            randomized_values[var_name] = rng.choice(var_values)
+
+    # Substitute ~var placeholders into each string's cached token list, so the
+    # templates are only scanned once however many versions are generated
+    pattern = variable_pattern(tuple(randomized_values))
+    replacements = {var_name: str(value) for var_name, value in randomized_values.items()}
+
+    def substitute(text):
+        if replacements and '~' in text:
+            parts = list(split_template(pattern, text))
+            for i in range(1, len(parts), 2):
+                parts[i] = replacements[parts[i]]
+            text = ''.join(parts)
+        return evaluate_embedded_expressions(text)
+
+    # Update the prompt and choices with the randomized variables
+    updated_prompt = substitute(question['prompt'])
+    updated_choices = [substitute(choice) for choice in question['choices']]
+
+    # Choice order is unchanged by substitution, so the answer is identified by
+    # its position in the template rather than by substituting its text
+    if correct_index is None:
+        correct_index = question['choices'].index(question['correct'])
+
+    # Return the processed question with updated prompt, choices, and correct answer position
     return {
         'id': f"{question['id']}_v{version_id}",  # Append version id to make each question unique
         'prompt': updated_prompt,
         'choices': updated_choices,
-        'correct': updated_correct_answer
+        'correct_index': correct_index
     }
 
-def create_qti_package(questions):
-    """Create a QTI package containing questions and images."""
-    os.makedirs("qti_temp", exist_ok=True)
+def item_start_tag(question_id):
+    """Return the serialized opening <item> tag (without its closing '>') for a question id."""
+    # Encode like prettify so non-ASCII ids match the item XML byte for byte
+    return ET.tostring(ET.Element("item", {"ident": question_id, "title": question_id}), encoding="utf-8")[:-2]
 
-    # Generate XML files
+def create_qti_package(questions, compresslevel=1):
+    """Create a QTI package containing questions and images."""
     manifest_items = []
 
-    for i, q in enumerate(questions):
-        file_name = f'question{i + 1}.xml'
-        file_path = os.path.join("qti_temp", file_name)
-        manifest_items.append((file_name, q['id']))
-        with open(file_path, "wb") as f:
-            f.write(generate_qti_item_xml(q['id'], q['prompt'], q['choices'], q['correct']).encode('utf-8'))
+    # Item XML keyed by rendered content, so versions that randomized to the
+    # same question are only built once. Duplicates only occur between versions
+    # of one template, so at most NUM_VERSIONS recent items are kept
+    xml_cache = {}
 
-    # Create the manifest XML file
-    with open("qti_temp/imsmanifest.xml", "w", encoding="utf-8") as f:
-        f.write(generate_manifest_xml(manifest_items))
-
-    # Zip the contents
+    # Build under a temporary name and only replace the previous package once
+    # every question has been written, so a failing question can't leave a
+    # partial archive behind
     zip_name = "qti_package.zip"
-    with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk("qti_temp"):
-            for file in files:
-                zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), "qti_temp"))
-
-    # Clean up
-    for file in os.listdir("qti_temp"):
-        file_path = os.path.join("qti_temp", file)
-        if os.path.isdir(file_path):
-            shutil.rmtree(file_path)
-        else:
-            os.remove(file_path)
-    os.rmdir("qti_temp")
+    temp_name = f"{zip_name}.tmp"
+
+    # Write the generated XML straight into the zip, buffering the archive so
+    # DEFLATE output reaches the disk in large writes. The default level 1
+    # compresses the small, repetitive XML nearly as well as zlib's default at a
+    # fraction of the cost
+    # Opened outside the try so a failed open reports its own error rather
+    # than one from cleaning up a file that was never created
+    zip_file = open(temp_name, "wb", buffering=1 << 20)
+    try:
+        with zip_file, zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zipf:
+            for i, q in enumerate(questions):
+                file_name = f'question{i + 1}.xml'
+                manifest_items.append((file_name, q['id']))
+
+                key = (q['prompt'], tuple(q['choices']), q['correct_index'])
+                item_xml = None
+                cached = xml_cache.get(key)
+                if cached is not None:
+                    # Identical content: only the item's ident/title need to change
+                    cached_id, cached_xml = cached
+                    cached_tag = item_start_tag(cached_id)
+                    if cached_tag in cached_xml:
+                        item_xml = cached_xml.replace(cached_tag, item_start_tag(q['id']), 1)
+                if item_xml is None:
+                    # Never reuse cached bytes whose id could not be rewritten
+                    item_xml = generate_qti_item_xml(q['id'], q['prompt'], q['choices'], q['correct_index'])
+                    xml_cache[key] = (q['id'], item_xml)
+                    if len(xml_cache) > NUM_VERSIONS:
+                        del xml_cache[next(iter(xml_cache))]
+                zipf.writestr(file_name, item_xml)
+
+            # Create the manifest XML file
+            zipf.writestr("imsmanifest.xml", generate_manifest_xml(manifest_items))
+    except BaseException:
+        os.remove(temp_name)
+        raise
+    os.replace(temp_name, zip_name)
 
     return zip_name
 
-def process_text_with_latex(prompt):
-    """Replace $...$ with <img> tags linking to Canvas-rendered LaTeX images."""
-    latex_pattern = r'(\$.*?\$)'
-    segments = []
-    last_index = 0
-
-    for match in re.finditer(latex_pattern, prompt):
-        start, end = match.span()
-
-        if start > last_index:
-            segments.append(('text', prompt[last_index:start]))
-
-        latex_code = match.group(0)[1:-1]  # strip the $ symbols
-        img_url = generate_equation_url(latex_code)
-        img_tag = (
-            f'<img class="equation_image" title="{latex_code}" '
-            f'src="{img_url}" alt="LaTeX: {latex_code}" '
-            f'data-equation-content="{latex_code}" loading="lazy" />'
-        )
-        segments.append(('img', img_tag))
-
-        last_index = end
+# Inline LaTeX delimited by $...$, compiled once for every prompt and choice
+_LATEX_RE = re.compile(r'\$(.*?)\$')
 
-    if last_index < len(prompt):
-        segments.append(('text', prompt[last_index:]))
+# Canvas equation image markup, filled in with the LaTeX source and its URL
+_IMG_TEMPLATE = (
+    '<img class="equation_image" title="{latex}" '
+    'src="{url}" alt="LaTeX: {latex}" '
+    'data-equation-content="{latex}" loading="lazy" />'
+)
 
-    final_html = ""
-    for typ, content in segments:
-        final_html += content
+# Rendered <img> tags keyed by LaTeX source, shared across all question versions
+_latex_img_cache = {}
 
-    return final_html
+def latex_to_img_tag(latex_code):
+    """Return the <img> tag for a LaTeX expression, building it once per run."""
+    img_tag = _latex_img_cache.get(latex_code)
+    if img_tag is None:
+        img_tag = _IMG_TEMPLATE.format(latex=latex_code, url=generate_equation_url(latex_code))
+        _latex_img_cache[latex_code] = img_tag
+    return img_tag
 
-def generate_qti_item_xml(question_id, prompt, choices, correct):
-    """Generate QTI 1.2 XML for a single multiple choice question."""
-    Element = ET.ElementTree
-    SubElement = ET.SubElement
+def process_text_with_latex(prompt):
+    """Replace $...$ with <img> tags linking to Canvas-rendered LaTeX images."""
+    # Splitting on the capturing pattern alternates text (even) and LaTeX (odd) parts
+    parts = _LATEX_RE.split(prompt)
+    for i in range(1, len(parts), 2):
+        parts[i] = latex_to_img_tag(parts[i])
 
-    prompt_html = process_text_with_latex(prompt)
+    return ''.join(parts)
 
-    # Generate images for each choice and use them in the choices
-    choice_urls = []
-    for choice in choices:
-        choice_html = process_text_with_latex(choice)
-        choice_urls.append(choice_html)
+def build_item_template():
+    """Build the static QTI 1.2 skeleton shared by every multiple choice question."""
+    SubElement = ET.SubElement
 
+    # Build the full QTI structure first so the item is created in the same document
+    questestinterop = ET.Element("questestinterop")
+    assessment = SubElement(questestinterop, "assessment", title="My Quiz")
+    section = SubElement(assessment, "section", ident="root_section")
 
-    # Create the root item element
-    item = ET.Element("item", {"ident": question_id, "title": question_id})
+    # Create the item element inside the section; ident/title are set per question
+    item = SubElement(section, "item")
 
     # Add presentation section
     presentation = SubElement(item, "presentation")
     material = SubElement(presentation, "material")
-    mattext = SubElement(material, "mattext", attrib={"texttype": "text/html"})
-    mattext.text = prompt_html
+    SubElement(material, "mattext", attrib={"texttype": "text/html"})
 
-    # Add response section
+    # Add response section; choices are added per question
     response_lid = SubElement(presentation, "response_lid", attrib={"ident": "response1", "rcardinality": "Single"})
-    render_choice = SubElement(response_lid, "render_choice")
-
-    # Add choices to response section
-    for i, choice_html in enumerate(choice_urls):
-        ident = f"choice{i + 1}"
-        response_label = SubElement(render_choice, "response_label", attrib={"ident": ident})
-        choice_material = SubElement(response_label, "material")
-        choice_mattext = SubElement(choice_material, "mattext", attrib={"texttype": "text/html"})
-        choice_mattext.text = choice_html
+    SubElement(response_lid, "render_choice")
 
     # Add resprocessing section for feedback and scoring
     resprocessing = SubElement(item, "resprocessing")
     outcomes = SubElement(resprocessing, "outcomes")
     SubElement(outcomes, "decvar", attrib={"varname": "SCORE", "vartype": "Decimal", "minvalue": "0", "maxvalue": "100", "cutvalue": "50"})
 
-    # Identify correct answer
-    correct_index = choices.index(correct)
-    correct_ident = f"choice{correct_index + 1}"
-
     respcondition = SubElement(resprocessing, "respcondition", attrib={"continue": "No"})
     conditionvar = SubElement(respcondition, "conditionvar")
-    varequal = SubElement(conditionvar, "varequal", attrib={"respident": "response1"})
-    varequal.text = correct_ident
+    SubElement(conditionvar, "varequal", attrib={"respident": "response1"})
     SubElement(respcondition, "setvar", attrib={"action": "Set"}).text = "100"
     SubElement(respcondition, "displayfeedback", attrib={"feedbacktype": "Response", "linkrefid": "correct"})
 
-    # Now wrap the generated item with the full QTI structure
-    questestinterop = ET.Element("questestinterop")
-    assessment = SubElement(questestinterop, "assessment", title="My Quiz")
-    section = SubElement(assessment, "section", ident="root_section")
+    return questestinterop
+
+# Copied for each question instead of rebuilding the static elements every time
+_ITEM_TEMPLATE = build_item_template()
 
-    # Add the item to the section
-    section.append(item)
+def generate_qti_item_xml(question_id, prompt, choices, correct_index):
+    """Generate QTI 1.2 XML for a single multiple choice question."""
+    SubElement = ET.SubElement
+
+    questestinterop = copy.deepcopy(_ITEM_TEMPLATE)
+    item = questestinterop.find("assessment/section/item")
+    item.set("ident", question_id)
+    item.set("title", question_id)
+
+    # Fill in the prompt
+    mattext = item.find("presentation/material/mattext")
+    mattext.text = ET.CDATA(process_text_with_latex(prompt))
+
+    # Add choices to response section
+    render_choice = item.find("presentation/response_lid/render_choice")
+    for i, choice in enumerate(choices):
+        ident = f"choice{i + 1}"
+        response_label = SubElement(render_choice, "response_label", attrib={"ident": ident})
+        choice_material = SubElement(response_label, "material")
+        choice_mattext = SubElement(choice_material, "mattext", attrib={"texttype": "text/html"})
+        choice_mattext.text = ET.CDATA(process_text_with_latex(choice))
+
+    # Identify correct answer
+    correct_ident = f"choice{correct_index + 1}"
+    item.find("resprocessing/respcondition/conditionvar/varequal").text = correct_ident
 
     # Prettify the XML output using the prettify function
     return prettify(questestinterop)
@@ -225,7 +335,9 @@ def generate_manifest_xml(items):
                 "http://www.imsglobal.org/xsd/imsqti_v1p2 imsqti_v1p2.xsd"
             ),
             "identifier": "man00001"
-        }
+        },
+        # Map the manifest namespace as the default so lxml emits no ns0: prefix
+        nsmap={None: ns[''], 'xsi': ns['xsi']}
     )
 
     # Create organizations and resources elements
@@ -248,31 +360,31 @@ def generate_manifest_xml(items):
 
 
 def prettify(elem):
-    # Using lxml's tostring function with no escape
-    # Serialize the tree to a string with 'xml' encoding, no escaping
-    xml_bytes = ET.tostring(elem, pretty_print=True, encoding="utf-8", xml_declaration=True, method="xml")
-    xml_str = xml_bytes.decode("utf-8")
-    
+    # Serialize the tree to UTF-8 bytes ready to be written into the zip; HTML
+    # content is already wrapped in CDATA and namespaces are mapped explicitly,
+    # so the output needs no post-processing
+    return ET.tostring(elem, pretty_print=True, encoding="utf-8", xml_declaration=True, method="xml")
 
-    # Replace escaped characters with literal ones
-    xml_str = xml_str.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
-    xml_str = xml_str.replace("ns0:", '').replace("/ns0:",'')
-    return xml_str
+def generate_versions(questions):
+    """Yield randomized versions of each question one at a time."""
+    version_id = 1
+    for q in questions:
+        # Draw every version's value for each variable in one call
+        picks = {name: rng.choices(values, k=NUM_VERSIONS) for name, values in q['variables'].items()}
+        # The answer's position is the same for every version of the question
+        correct_index = q['choices'].index(q['correct'])
+        for i in range(NUM_VERSIONS):
+            randomized_values = {name: values[i] for name, values in picks.items()}
+            yield process_question(q, version_id, randomized_values, correct_index)
+            version_id += 1
 
 def main():
     """Main entry point for the script."""
     questions = load_json("example.json")["questions"]
-    
-    # Process the questions and generate randomized versions
-    processed_questions = []
-    version_id = 1
-    for q in questions:
-        for _ in range(1):  # Creating 4 randomized versions of each question
-            processed_questions.append(process_question(q, version_id))
-            version_id += 1
-    
-    # Create the QTI package
-    qti_package = create_qti_package(processed_questions)
+
+    # Process the questions lazily so each version is written to the package
+    # as soon as it is generated
+    qti_package = create_qti_package(generate_versions(questions))
     print(f"QTI package created: {qti_package}")
 
 if __name__ == "__main__":